@@ -9,9 +9,16 @@ from rich_click import RichCommand, RichGroup
 
 from .game import Game
 from .jukebox import Jukebox
+from .library import library
+from .loops import detect_library_loops
+from .profiling import profiler
+from .seams import SEAM_METRICS, scan_library_seams
+from .streaming import STREAM_FORMATS, JukeboxStream
 from .weather import Weather
 
 if TYPE_CHECKING:
+    from typing import Coroutine
+
     from click import Context, Parameter
 
 
@@ -60,6 +67,29 @@ def validate_hour(
         raise click.BadParameter("Could not parse hour value in AM/PM format")
 
 
+def open_stream(ctx: "Context") -> Optional[JukeboxStream]:
+    if not ctx.obj["stream_port"]:
+        return None
+    stream = JukeboxStream(
+        host=ctx.obj["stream_host"],
+        port=ctx.obj["stream_port"],
+        stream_format=ctx.obj["stream_format"],
+        bitrate=ctx.obj["stream_bitrate"],
+    )
+    stream.open_output()
+    return stream
+
+
+def run_jukebox(j: Jukebox, play: "Coroutine", stream: Optional[JukeboxStream]) -> None:
+    try:
+        asyncio.run(stream.serve(play) if stream else play)
+    except KeyboardInterrupt:
+        if not stream:
+            asyncio.run(j.stop())
+    finally:
+        library.stop_watching()
+
+
 @group(cls=RichGroup, context_settings={"auto_envvar_prefix": "KKJUKEBOX"})
 @option(
     "--force-cut",
@@ -82,9 +112,63 @@ def validate_hour(
     show_envvar=True,
     help="Directory where music is located.",
 )
+@option(
+    "--watch-library/--no-watch-library",
+    default=True,
+    show_default=True,
+    show_envvar=True,
+    help="Watch the music directory for added or removed songs while playing.",
+)
+@option(
+    "--stream-port",
+    type=int,
+    default=None,
+    show_envvar=True,
+    help="Serve music as an HTTP audio stream on this port instead of playing it locally.",
+)
+@option(
+    "--stream-host",
+    default="0.0.0.0",
+    show_default=True,
+    show_envvar=True,
+    help="Address to serve the stream on.",
+)
+@option(
+    "--stream-format",
+    type=Choice(list(STREAM_FORMATS)),
+    default="mp3",
+    show_default=True,
+    show_envvar=True,
+    help="Audio format of the stream.",
+)
+@option(
+    "--stream-bitrate",
+    type=int,
+    default=128,
+    show_default=True,
+    show_envvar=True,
+    help="Bitrate of the stream in kbps.",
+)
+@option(
+    "--profile",
+    "profile_dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    show_envvar=True,
+    help="Profile the session, writing flame-graph stacks and a summary to this directory.",
+)
 @click.pass_context
 def cli(
-    ctx: "Context", force_cut: bool, log_level: Optional[str], music_dir: str
+    ctx: "Context",
+    force_cut: bool,
+    log_level: Optional[str],
+    music_dir: str,
+    watch_library: bool,
+    stream_port: Optional[int],
+    stream_host: str,
+    stream_format: str,
+    stream_bitrate: int,
+    profile_dir: Optional[str],
 ) -> None:
     """
     Play music from your favorite Animal Crossing games.
@@ -92,6 +176,15 @@ def cli(
     ctx.ensure_object(dict)
     set_log_level(log_level)
     ctx.obj["force_cut"] = force_cut
+    ctx.obj["watch_library"] = watch_library
+    ctx.obj["stream_port"] = stream_port
+    ctx.obj["stream_host"] = stream_host
+    ctx.obj["stream_format"] = stream_format
+    ctx.obj["stream_bitrate"] = stream_bitrate
+
+    if profile_dir:
+        profiler.start(profile_dir)
+        ctx.call_on_close(lambda: click.echo(profiler.stop()))
     ctx.obj["music_idr"] = music_dir
 
 
@@ -148,16 +241,15 @@ def kk(
     Play music from KK Slider, either a single SONG_NAME or randomizable version-setlists.
     """
     force_cut = ctx.obj["force_cut"]
+    stream = open_stream(ctx)
     j = Jukebox(
         force_cut=force_cut,
         loop_length=loop_length,
         loop_upper_secs=ll_upper,
         loop_lower_secs=ll_lower,
+        watch_library=ctx.obj["watch_library"],
     )
-    try:
-        asyncio.run(j.play_kk(versions, song_name=song_name))
-    except KeyboardInterrupt:
-        asyncio.run(j.stop())
+    run_jukebox(j, j.play_kk(versions, song_name=song_name), stream)
 
 
 @cli.command(cls=RichCommand)
@@ -198,6 +290,22 @@ def kk(
     show_envvar=True,
     help='The location to use for sourcing real-time weather. Can be "local" to lookup (using IP geocoding) the current location.',
 )
+@option(
+    "--warm-up-secs",
+    type=int,
+    default=300,
+    show_default=True,
+    show_envvar=True,
+    help="How many seconds before the top of the hour to start preparing every track that could play in the next hour.",
+)
+@option(
+    "--weather-check-secs",
+    type=int,
+    default=300,
+    show_default=True,
+    show_envvar=True,
+    help='How often in seconds to re-check real-time weather and crossfade to the matching variant. Only used when --weather is set to "location".',
+)
 @option(
     "--loop-length",
     type=click.UNPROCESSED,
@@ -232,6 +340,8 @@ def hourly(
     hour: int | Literal["now", "random"],
     weather: str,
     location: str,
+    warm_up_secs: int,
+    weather_check_secs: int,
     loop_length: int | Literal["random"],
     ll_upper: int,
     ll_lower: int,
@@ -240,16 +350,99 @@ def hourly(
     Play seamlessly-looping hourly music.
     """
     force_cut = ctx.obj["force_cut"]
+    stream = open_stream(ctx)
     j = Jukebox(
         force_cut=force_cut,
         loop_length=loop_length,
         loop_upper_secs=ll_upper,
         loop_lower_secs=ll_lower,
+        weather_check_secs=weather_check_secs,
+        warm_up_secs=warm_up_secs,
+        watch_library=ctx.obj["watch_library"],
     )
-    try:
-        asyncio.run(j.play_hourly(hour, game, weather, location))
-    except KeyboardInterrupt:
-        asyncio.run(j.stop())
+    run_jukebox(j, j.play_hourly(hour, game, weather, location), stream)
+
+
+@cli.command("detect-loops", cls=RichCommand)
+@option(
+    "--all",
+    "include_timed",
+    is_flag=True,
+    show_envvar=True,
+    help="Also detect loops for songs that already have bundled loop timings.",
+)
+@option(
+    "--min-loop-secs",
+    type=float,
+    default=20.0,
+    show_default=True,
+    show_envvar=True,
+    help="Shortest loop length in seconds to consider.",
+)
+@option(
+    "-j",
+    "--workers",
+    type=int,
+    default=None,
+    show_envvar=True,
+    help="Number of songs to analyze in parallel. Defaults to the number of CPUs.",
+)
+@click.pass_context
+def detect_loops(
+    ctx: "Context", include_timed: bool, min_loop_secs: float, workers: Optional[int]
+) -> None:
+    """
+    Detect loop points for songs missing from the bundled loop timings.
+    """
+    detected, attempted, output_path = detect_library_loops(
+        include_timed=include_timed, min_loop_secs=min_loop_secs, workers=workers
+    )
+    click.echo(f"Detected loops for {detected} of {attempted} songs in {output_path}")
+
+
+@cli.command("scan-seams", cls=RichCommand)
+@option(
+    "--sort-by",
+    type=Choice(SEAM_METRICS),
+    default="discontinuity",
+    show_default=True,
+    show_envvar=True,
+    help="Which seam measurement to rank songs by, worst first.",
+)
+@option(
+    "--top",
+    type=int,
+    default=None,
+    show_envvar=True,
+    help="Only show this many of the worst-ranked songs.",
+)
+@option(
+    "-j",
+    "--workers",
+    type=int,
+    default=None,
+    show_envvar=True,
+    help="Number of songs to analyze in parallel. Defaults to the number of CPUs.",
+)
+@click.pass_context
+def scan_seams(
+    ctx: "Context", sort_by: str, top: Optional[int], workers: Optional[int]
+) -> None:
+    """
+    Measure the loop seam of every timed song and report the worst first.
+    """
+    report = scan_library_seams(sort_by=sort_by, workers=workers)
+    song_width = max([len(r["song"]) for r in report] + [4])
+    click.echo(
+        f"{'song':<{song_width}}  {'start':>8}  {'end':>8}  "
+        f"{'discont.':>8}  {'spec dB':>8}  {'gain dB':>8}"
+    )
+    for r in report[:top]:
+        click.echo(
+            f"{r['song']:<{song_width}}  {r['start']:>8}  {r['end']:>8}  "
+            f"{r['discontinuity']:>8.2f}  {r['spectral_db']:>8.2f}  "
+            f"{r['gain_jump_db']:>8.2f}"
+        )
 
 
 if __name__ == "__main__":
@@ -6,14 +6,18 @@ import asyncio
 import datetime
 import logging
 import random
+from functools import partial
+from pathlib import Path
 from time import monotonic
-from typing import TYPE_CHECKING, Literal, Optional
+from typing import TYPE_CHECKING, Callable, Literal, Optional
 
 import pygame
 
 from .game import Game
+from .library import library, song_keys
 from .location import get_location
-from .song import HourlySong, KKSong, Song
+from .profiling import profiler
+from .song import LOOPABLE_KK_VERSIONS, MUSIC_DIR, HourlySong, KKSong, Song
 from .weather import Weather, get_weather
 
 log = logging.getLogger("kkjukebox")
@@ -33,24 +37,50 @@ class Jukebox:
     loop_upper_secs: int
     loop_lower_secs: int
 
+    watch_library: bool
     setlist: list[tuple[str, str]]
+    setlist_versions: list[str]
+    _curr_setlist: list[tuple[str, str]]
+    _background_tasks: set[asyncio.Task]
 
     now_playing: Song
     now_playing_start_time: float
     now_playing_length: float
 
+    weather_check_secs: int
+    weather_crossfade_ms: int
+    weather_checked_time: float
+    _weather_variants: dict[Weather, tuple[HourlySong, "pygame.mixer.Sound"]]
+    _weather_variants_key: Optional[tuple[int, Game]]
+    _variant_channel: Optional["pygame.mixer.Channel"]
+
+    warm_up_secs: int
+    _warmed_up_hour: Optional[datetime.datetime]
+
     def __init__(
         self,
         force_cut: bool = False,
         loop_length: int | Literal["random"] = 60,
         loop_upper_secs: int = 60,
         loop_lower_secs: int = 120,
+        weather_check_secs: int = 300,
+        weather_crossfade_ms: int = 3000,
+        watch_library: bool = True,
+        warm_up_secs: int = 300,
     ) -> None:
         self.force_cut = force_cut
         self._loop_length = loop_length
         self.loop_upper_secs = loop_upper_secs
         self.loop_lower_secs = loop_lower_secs
         self.now_playing_length = 0
+        self.weather_check_secs = weather_check_secs
+        self.weather_crossfade_ms = weather_crossfade_ms
+        self.weather_checked_time = 0
+        self._weather_variants = {}
+        self._weather_variants_key = None
+        self._variant_channel = None
+        self.warm_up_secs = warm_up_secs
+        self._warmed_up_hour = None
 
         self.has_next_song = False
         self.randomized_hour = False
@@ -58,7 +88,11 @@ class Jukebox:
         self.randomized_weather = False
         self.localized_weather = False
         self.change_hourly = True
+        self.watch_library = watch_library
         self.setlist = []
+        self.setlist_versions = []
+        self._curr_setlist = []
+        self._background_tasks = set()
         pygame.mixer.init()
 
     def get_loop_length(self):
@@ -68,15 +102,132 @@ class Jukebox:
             return self._loop_length
 
     def _get_curr_location(self) -> str | None:
-        return get_location()
+        with profiler.phase("location"):
+            return get_location()
 
     async def _get_curr_weather(self, location: str) -> "Weather":
-        return await get_weather(location)
+        with profiler.phase("weather"):
+            return await get_weather(location)
+
+    def _load_music(
+        self, filepath: str | Path, loop_filepath: Optional[str] = None
+    ) -> None:
+        with profiler.phase("load"):
+            pygame.mixer.music.load(filepath)
+            if loop_filepath:
+                pygame.mixer.music.queue(loop_filepath, loops=-1)
+
+    def _start_watching(self) -> None:
+        if not self.watch_library:
+            return
+        loop = asyncio.get_running_loop()
+        library.watch(
+            MUSIC_DIR,
+            on_added=lambda p: loop.call_soon_threadsafe(self._song_added, p),
+            on_removed=lambda p: loop.call_soon_threadsafe(self._song_removed, p),
+        )
+
+    def _song_added(self, path: Path) -> None:
+        keys = song_keys(MUSIC_DIR, path)
+        if not keys:
+            return
+
+        make_song: Optional[Callable[[], HourlySong | KKSong]] = None
+        if keys[0] == "kk":
+            _, name, version = keys
+            entry = (version, name)
+            if version in self.setlist_versions and entry not in self.setlist:
+                self.setlist.append(entry)
+                position = random.randint(0, len(self._curr_setlist))
+                self._curr_setlist.insert(position, entry)
+                log.info(f"Added to setlist: {name} ({version})")
+            if version in LOOPABLE_KK_VERSIONS:
+                make_song = partial(KKSong, name, version)
+        else:
+            _, game, weather, hour = keys
+            if hour.isdigit() and 0 <= int(hour) <= 23:
+                make_song = partial(HourlySong, int(hour), Game(game), Weather(weather))
+
+        if make_song:
+            task = asyncio.create_task(self._cut_new_song(path, make_song))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+
+    def _song_removed(self, path: Path) -> None:
+        keys = song_keys(MUSIC_DIR, path)
+        if not keys or keys[0] != "kk":
+            return
+        _, name, version = keys
+        entry = (version, name)
+        if entry in self.setlist:
+            self.setlist.remove(entry)
+            log.info(f"Removed from setlist: {name} ({version})")
+        if entry in self._curr_setlist:
+            self._curr_setlist.remove(entry)
+
+    async def _cut_new_song(
+        self, path: Path, make_song: Callable[[], HourlySong | KKSong]
+    ) -> None:
+        # cut in the background so the song is ready by the time it's picked
+        try:
+            song = make_song()
+            await asyncio.to_thread(song.make_loop_files)
+        except (OSError, KeyError, ValueError) as e:
+            log.debug(f"Could not cut new song {path} ({type(e).__name__}: {e})")
+        else:
+            log.debug(f"Cut loop files for new song {song}")
+
+    def _start_warm_up(
+        self, hour: int, games: list[Game], weathers: list[Weather]
+    ) -> None:
+        if self.force_cut:
+            log.debug("Skipping warm-up since loops are re-cut when played.")
+            return
+        task = asyncio.create_task(self._warm_up(hour, games, weathers))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _warm_up(
+        self, hour: int, games: list[Game], weathers: list[Weather]
+    ) -> None:
+        # cut every track that could be picked for the hour ahead of time, so rotations
+        # within the hour never wait on a cut
+        songs: dict[Path, HourlySong] = {}
+        for g in games:
+            for w in weathers:
+                try:
+                    h = HourlySong(hour, g, w)
+                except OSError as e:
+                    log.debug(f"Nothing to warm up for {hour} ({g}/{w}): {e}")
+                    continue
+                songs.setdefault(h.filepath, h)
+
+        log.debug(f"Warming up {len(songs)} tracks for hour {hour}.")
+        # leave some CPU for playback
+        workers = asyncio.Semaphore(max(1, (os.cpu_count() or 2) // 2))
+
+        async def cut(h: HourlySong) -> None:
+            async with workers:
+                try:
+                    await asyncio.to_thread(h.make_loop_files)
+                except (OSError, KeyError) as e:
+                    log.debug(f"Could not warm up {h} ({type(e).__name__}: {e})")
+
+        await asyncio.gather(*(cut(h) for h in songs.values()))
+        log.debug(f"Warmed up tracks for hour {hour}.")
 
     async def stop(self, fadeout_secs: int = 2) -> None:
         pygame.mixer.music.fadeout(fadeout_secs * 1000)
+        pygame.mixer.fadeout(fadeout_secs * 1000)
         await asyncio.sleep(fadeout_secs)
         pygame.mixer.music.unload()
+        self._variant_channel = None
+
+    @property
+    def _is_playing(self) -> bool:
+        if pygame.mixer.music.get_busy():
+            return True
+        return bool(self._variant_channel and self._variant_channel.get_busy())
 
     @property
     def _time_for_next_song(self) -> bool:
@@ -85,6 +236,51 @@ class Jukebox:
         else:
             return False
 
+    @property
+    def _time_for_weather_check(self) -> bool:
+        if self.localized_weather:
+            return (monotonic() - self.weather_checked_time) > self.weather_check_secs
+        else:
+            return False
+
+    async def _prepare_weather_variants(
+        self, hour: int, game: Game, playing: HourlySong, playing_loop_filepath: str
+    ) -> None:
+        # cut and decode every weather's loop up front so a weather change can be
+        # crossfaded straight away; the playing variant was just cut, so reuse it
+        if self._weather_variants_key == (hour, game):
+            return
+
+        variants: dict[Weather, tuple[HourlySong, pygame.mixer.Sound]] = {}
+        for w in Weather:
+            if w is playing.weather:
+                h, loop_filepath = playing, playing_loop_filepath
+            else:
+                try:
+                    h = HourlySong(hour, game, w)
+                    _, loop_filepath = await asyncio.to_thread(h.make_loop_files)
+                except (OSError, KeyError) as e:
+                    log.debug(f"No {w} variant available for {hour} ({game}): {e}")
+                    continue
+            with profiler.phase("load"):
+                sound = await asyncio.to_thread(pygame.mixer.Sound, loop_filepath)
+            variants[w] = (h, sound)
+        self._weather_variants = variants
+        self._weather_variants_key = (hour, game)
+        log.debug(f"Weather variants ready: {[w.value for w in variants]}")
+
+    def _crossfade_weather(self, weather: Weather) -> None:
+        h, loop_sound = self._weather_variants[weather]
+        if self._variant_channel and self._variant_channel.get_busy():
+            self._variant_channel.fadeout(self.weather_crossfade_ms)
+        else:
+            pygame.mixer.music.fadeout(self.weather_crossfade_ms)
+        self._variant_channel = loop_sound.play(
+            loops=-1, fade_ms=self.weather_crossfade_ms
+        )
+        self.now_playing = h
+        log.info(f"Now Playing: {h}!")
+
     def _set_playback_length(self) -> None:
         self.now_playing_length = self.get_loop_length()
         log.debug(f"Current playback length: {self.now_playing_length}")
@@ -129,13 +325,31 @@ class Jukebox:
         if self.localized_weather and location == "local":
             location = self._get_curr_location()
 
+        self._start_watching()
+
+        candidate_games = list(Game) if self.randomized_game else [Game(game)]
+        if self.randomized_weather or self.localized_weather:
+            candidate_weathers = list(Weather)
+        else:
+            candidate_weathers = [Weather(weather)]
+        if not self.randomized_hour and len(candidate_games) > 1:
+            self._start_warm_up(hour_24, candidate_games, candidate_weathers)
+
         while True:
             now = datetime.datetime.now()
             one_hour = datetime.timedelta(hours=1)
             next_hour = now.replace(microsecond=0, second=0, minute=0) + one_hour
             # log.debug(f"Time until next hour: {(next_hour - now).total_seconds()}")
 
-            if not pygame.mixer.music.get_busy():
+            if (
+                self.change_hourly
+                and self._warmed_up_hour != next_hour
+                and (next_hour - now).total_seconds() < self.warm_up_secs
+            ):
+                self._warmed_up_hour = next_hour
+                self._start_warm_up(next_hour.hour, candidate_games, candidate_weathers)
+
+            if not self._is_playing:
                 if self.randomized_hour:
                     if not hours_shuffled:
                         hours_shuffled = random.sample(range(24), k=24)
@@ -154,6 +368,7 @@ class Jukebox:
                     curr_weather = (
                         await self._get_curr_weather(location) or Weather.SUNNY
                     )
+                    self.weather_checked_time = monotonic()
                 elif self.randomized_weather:
                     curr_weather = random.choice([w for w in Weather])
                     log.debug(f"Random weather is {curr_weather}")
@@ -165,10 +380,15 @@ class Jukebox:
                 self.now_playing = h
                 self._set_playback_length()
                 log.info(f"Now Playing: {h}!")
-                pygame.mixer.music.load(hour_start_filepath)
-                pygame.mixer.music.queue(hour_loop_filepath, loops=-1)
+                self._load_music(hour_start_filepath, hour_loop_filepath)
                 self.now_playing_start_time = monotonic()
                 pygame.mixer.music.play()
+
+                if self.localized_weather:
+                    # audio keeps playing while the other variants are cut and decoded
+                    await self._prepare_weather_variants(
+                        hour_24, curr_game, h, hour_loop_filepath
+                    )
             elif self.change_hourly and (next_hour - now).total_seconds() < 10.0:
                 log.debug(f"Preparing for next hour ({next_hour}).")
                 hour_24 = next_hour.hour
@@ -178,6 +398,20 @@ class Jukebox:
             elif self._time_for_next_song:
                 log.debug("Preparing for next song.")
                 await self.stop(2)
+            elif self._time_for_weather_check:
+                log.debug("Checking for weather changes.")
+                new_weather = await self._get_curr_weather(location) or Weather.SUNNY
+                self.weather_checked_time = monotonic()
+                if new_weather is curr_weather:
+                    pass
+                elif new_weather in self._weather_variants:
+                    log.debug(f"Weather changed to {new_weather}; crossfading.")
+                    self._crossfade_weather(new_weather)
+                    curr_weather = new_weather
+                else:
+                    log.debug(
+                        f"No {new_weather} variant ready; keeping {curr_weather}."
+                    )
             else:
                 await asyncio.sleep(1)
 
@@ -201,41 +435,44 @@ class Jukebox:
             song_start_filepath, song_loop_filepath = kk_song.make_loop_files(
                 self.force_cut
             )
-            pygame.mixer.music.load(song_start_filepath)
-            pygame.mixer.music.queue(song_loop_filepath, loops=-1)
+            self._load_music(song_start_filepath, song_loop_filepath)
             log.info(f"Now Playing: {kk_song.name} ({kk_song.version})!")
             pygame.mixer.music.play()
             while True:
                 await asyncio.sleep(1)
         else:
             log.info(f"Now Playing: {kk_song.name} ({kk_song.version})!")
-            pygame.mixer.music.load(kk_song.filepath)
+            self._load_music(kk_song.filepath)
             pygame.mixer.music.play()
             while pygame.mixer.music.get_busy():
                 await asyncio.sleep(1)
 
     async def _play_setlist(self, versions: list[str]) -> None:
         self.has_next_song = True
+        self.setlist_versions = versions
         for v in versions:
             self.setlist.extend([(v, s) for s in KKSong.all_song_names(v)])
-        curr_setlist: list[tuple[str, str]] = []
+        self._start_watching()
 
         while True:
             if not pygame.mixer.music.get_busy():
-                if not curr_setlist:
-                    curr_setlist = self.setlist[:]
-                    random.shuffle(curr_setlist)
-                song_version, song_name = curr_setlist.pop(0)
+                if not self._curr_setlist:
+                    self._curr_setlist = self.setlist[:]
+                    random.shuffle(self._curr_setlist)
+                if not self._curr_setlist:
+                    log.debug("Setlist is empty; waiting for songs to be added.")
+                    await asyncio.sleep(1)
+                    continue
+                song_version, song_name = self._curr_setlist.pop(0)
                 next_song = KKSong(song_name, song_version)
                 if next_song.is_loopable:
                     self._set_playback_length()
                     song_start_filepath, song_loop_filepath = next_song.make_loop_files(
                         self.force_cut
                     )
-                    pygame.mixer.music.load(song_start_filepath)
-                    pygame.mixer.music.queue(song_loop_filepath, loops=-1)
+                    self._load_music(song_start_filepath, song_loop_filepath)
                 else:
-                    pygame.mixer.music.load(next_song.filepath)
+                    self._load_music(next_song.filepath)
 
                 self.now_playing = next_song
                 log.info(f"Now Playing: {self.now_playing}!")
@@ -0,0 +1,206 @@
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.observers import Observer
+from watchdog.observers.api import BaseObserver
+from watchdog.observers.polling import PollingObserver
+
+from .game import Game
+from .profiling import profiler
+from .weather import Weather
+
+ALLOWED_SONG_FILETYPES = [".mp3", ".ogg", ".wav"]
+SETTLE_POLL_SECS = 1.0
+
+log = logging.getLogger("kkjukebox")
+
+
+def _normalize(path: str | Path) -> Path:
+    return Path(os.path.abspath(path))
+
+
+class _LibraryEventHandler(FileSystemEventHandler):
+
+    def __init__(
+        self,
+        library: "Library",
+        on_added: Optional[Callable[[Path], object]],
+        on_removed: Optional[Callable[[Path], object]],
+        stopping: threading.Event,
+    ) -> None:
+        self.library = library
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.stopping = stopping
+
+    def _added(self, path: str | bytes) -> None:
+        song_path = _normalize(os.fsdecode(path))
+        if self.library.is_song_file(song_path):
+            threading.Thread(
+                target=self._add_when_settled, args=(song_path,), daemon=True
+            ).start()
+
+    def _add_when_settled(self, path: Path) -> None:
+        # files show up as soon as a copy starts; a half-copied song would be played
+        # or cut as-is, so wait for it to stop growing before indexing it
+        size = -1
+        try:
+            while (new_size := path.stat().st_size) != size:
+                size = new_size
+                if self.stopping.wait(SETTLE_POLL_SECS):
+                    return
+        except OSError:
+            return
+        if self.library.add(path) and self.on_added:
+            self.on_added(path)
+
+    def _removed(self, path: str | bytes) -> None:
+        song_path = _normalize(os.fsdecode(path))
+        if self.library.remove(song_path) and self.on_removed:
+            self.on_removed(song_path)
+
+    def on_created(self, event: FileSystemEvent) -> None:
+        if not event.is_directory:
+            self._added(event.src_path)
+
+    def on_deleted(self, event: FileSystemEvent) -> None:
+        if not event.is_directory:
+            self._removed(event.src_path)
+
+    def on_moved(self, event: FileSystemEvent) -> None:
+        if not event.is_directory:
+            self._removed(event.src_path)
+            self._added(event.dest_path)
+
+
+class Library:
+    """
+    In-memory index of song files by directory. While the music directory is being
+    watched, each directory is scanned once, the first time it's needed, and kept up
+    to date afterwards from filesystem events. Otherwise it's rescanned every time.
+    """
+
+    _index: dict[Path, dict[str, list[Path]]]
+    _lock: threading.Lock
+    _observer: Optional[BaseObserver]
+    _stopping: threading.Event
+
+    def __init__(self) -> None:
+        self._index = {}
+        self._lock = threading.Lock()
+        self._observer = None
+        self._stopping = threading.Event()
+
+    @staticmethod
+    def is_song_file(path: Path) -> bool:
+        return path.suffix in ALLOWED_SONG_FILETYPES and path.parent.name != "loops"
+
+    def _dir_index(self, song_dir: Path) -> dict[str, list[Path]]:
+        # must be called with the lock held
+        if song_dir in self._index:
+            return self._index[song_dir]
+        entries: dict[str, list[Path]] = {}
+        with profiler.phase("scan"):
+            if song_dir.is_dir():
+                for f in song_dir.iterdir():
+                    if self.is_song_file(f):
+                        entries.setdefault(f.stem, []).append(f)
+        # nothing keeps the index up to date without a watcher
+        if self._observer:
+            self._index[song_dir] = entries
+        return entries
+
+    def files(self, song_dir: str | Path, stem: str) -> list[Path]:
+        with self._lock:
+            return list(self._dir_index(_normalize(song_dir)).get(stem, []))
+
+    def song_names(self, song_dir: str | Path) -> list[str]:
+        with self._lock:
+            return list(self._dir_index(_normalize(song_dir)))
+
+    def add(self, path: Path) -> bool:
+        """Index a new song file, returning whether it is a song file at all."""
+        if not self.is_song_file(path):
+            return False
+        with self._lock:
+            entries = self._index.get(path.parent)
+            # unindexed directories pick the file up when they are first scanned
+            if entries is not None and path not in entries.get(path.stem, []):
+                entries.setdefault(path.stem, []).append(path)
+        log.debug(f"Library added {path}")
+        return True
+
+    def remove(self, path: Path) -> bool:
+        """Drop a song file from the index, returning whether it is a song file."""
+        if not self.is_song_file(path):
+            return False
+        with self._lock:
+            entries = self._index.get(path.parent)
+            if entries is not None and path in entries.get(path.stem, []):
+                entries[path.stem].remove(path)
+                if not entries[path.stem]:
+                    del entries[path.stem]
+        log.debug(f"Library removed {path}")
+        return True
+
+    def watch(
+        self,
+        music_dir: str | Path,
+        on_added: Optional[Callable[[Path], object]] = None,
+        on_removed: Optional[Callable[[Path], object]] = None,
+    ) -> None:
+        """
+        Start watching the music directory for added and removed songs. Uses the
+        native backend (inotify on Linux) and falls back to polling if that fails.
+        New songs are only indexed, and `on_added` only called, once they've stopped
+        growing. Callbacks are run on the watcher's threads.
+        """
+        if self._observer:
+            return
+        self._stopping.clear()
+        handler = _LibraryEventHandler(self, on_added, on_removed, self._stopping)
+        music_path = str(_normalize(music_dir))
+        observer: BaseObserver = Observer()
+        try:
+            observer.schedule(handler, music_path, recursive=True)
+            observer.start()
+        except OSError as e:
+            log.debug(f"Native library watching unavailable ({e}); polling instead")
+            observer = PollingObserver()
+            observer.schedule(handler, music_path, recursive=True)
+            observer.start()
+        self._observer = observer
+
+    def stop_watching(self) -> None:
+        if self._observer:
+            self._stopping.set()
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+            with self._lock:
+                self._index = {}
+
+
+def song_keys(music_dir: str | Path, path: Path) -> Optional[tuple[str, ...]]:
+    """
+    The keys a song's loop timings are stored under, i.e. ("hourly", game, weather,
+    hour) or ("kk", name, version), or None if the path isn't in a song directory.
+    """
+    try:
+        parts = _normalize(path).relative_to(_normalize(music_dir)).parts
+    except ValueError:
+        return None
+    if len(parts) != 3:
+        return None
+    if parts[0] == "kk":
+        return ("kk", Path(parts[2]).stem, parts[1])
+    if parts[0] in [g.value for g in Game] and parts[1] in Weather.all_values():
+        return ("hourly", parts[0], parts[1], Path(parts[2]).stem)
+    return None
+
+
+library = Library()
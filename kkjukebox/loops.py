@@ -0,0 +1,260 @@
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+from pydub import AudioSegment  # type: ignore
+
+from .game import Game
+from .song import (
+    ALLOWED_SONG_FILETYPES,
+    LOOPABLE_KK_VERSIONS,
+    MUSIC_DIR,
+    detected_loop_times_path,
+    load_detected_loop_times,
+)
+from .utils import load_json_resource
+from .weather import Weather
+
+ANALYSIS_FRAME_RATE = 22050
+FRAME_SIZE = 2048
+HOP_SIZE = 512
+NUM_BANDS = 48
+CANDIDATE_LAGS = 8
+MATCH_THRESHOLD = 0.8
+MATCH_SMOOTHING_SECS = 0.5
+MIN_MATCH_SECS = 3.0
+REFINE_WINDOW_SECS = 0.2
+
+log = logging.getLogger("kkjukebox")
+
+
+def _load_samples(path: str | Path) -> tuple[np.ndarray, int, np.ndarray]:
+    """
+    Decode a file to mono float samples at full rate (for sample-accurate refinement)
+    and at the reduced analysis rate (for feature extraction).
+    """
+    original = AudioSegment.from_file(path).set_channels(1)
+    reduced = original.set_frame_rate(ANALYSIS_FRAME_RATE)
+    scale = float(1 << (8 * original.sample_width - 1))
+    full = np.array(original.get_array_of_samples(), dtype=np.float32) / scale
+    analysis = np.array(reduced.get_array_of_samples(), dtype=np.float32) / scale
+    return full, original.frame_rate, analysis
+
+
+def _band_features(samples: np.ndarray) -> np.ndarray:
+    """
+    Log-compressed spectrogram pooled into log-spaced bands, centered per band and
+    normalized per frame so that frame dot products are cosine similarities.
+    """
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE]
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(FRAME_SIZE), axis=1))
+
+    edges = np.unique(np.geomspace(1, spectrum.shape[1], NUM_BANDS + 1).astype(int))
+    bands = np.add.reduceat(spectrum, edges[:-1], axis=1)
+    features = np.log1p(100 * bands)
+    features -= features.mean(axis=0)
+    features /= np.linalg.norm(features, axis=1, keepdims=True) + 1e-9
+    return features
+
+
+def _lag_similarity(features: np.ndarray) -> np.ndarray:
+    """
+    Mean frame similarity between the track and itself shifted by every possible lag,
+    computed for all lags at once with an FFT autocorrelation summed across bands.
+    """
+    n = len(features)
+    spectra = np.fft.rfft(features, n=2 * n, axis=0)
+    power = (spectra.real**2 + spectra.imag**2).sum(axis=1)
+    autocorr = np.fft.irfft(power, n=2 * n)[:n]
+    return autocorr / np.arange(n, 0, -1)
+
+
+def _longest_match(similarity: np.ndarray, smoothing: int) -> tuple[int, int]:
+    """
+    Start and length of the longest run of near-identical frames. Similarity is
+    smoothed first since onsets that fall between frames briefly dip below threshold.
+    """
+    smoothed = np.convolve(similarity, np.ones(smoothing) / smoothing, mode="same")
+    matching = np.concatenate(([0], smoothed > MATCH_THRESHOLD, [0]))
+    changes = np.flatnonzero(np.diff(matching.astype(np.int8)))
+    if not len(changes):
+        return 0, 0
+    starts, ends = changes[::2], changes[1::2]
+    longest = np.argmax(ends - starts)
+    return int(starts[longest]), int(ends[longest] - starts[longest])
+
+
+def _refine_lag(
+    samples: np.ndarray, frame_rate: int, anchor: int, lag: int, radius: int
+) -> int:
+    """
+    Narrow a frame-accurate loop length down to the sample by finding where the
+    waveform at `anchor` best reappears, using normalized cross-correlation.
+    """
+    window = int(REFINE_WINDOW_SECS * frame_rate)
+    radius = min(radius, len(samples) - anchor - lag - window)
+    if radius <= 0:
+        return lag
+
+    reference = samples[anchor : anchor + window]
+    search = samples[anchor + lag - radius : anchor + lag + radius + window]
+    corr = np.correlate(search, reference, mode="valid")
+    energy = np.cumsum(np.concatenate(([0.0], search**2)))
+    norms = np.sqrt(energy[window:] - energy[:-window]) + 1e-9
+    return lag - radius + int(np.argmax(corr / norms))
+
+
+def detect_loop(
+    path: str | Path, min_loop_secs: float = 20.0
+) -> Optional[dict[str, str]]:
+    """
+    Find loop start/end points for a track that repeats its loop section at least
+    partially, returning timings in the same shape as the bundled resources.
+    """
+    full, frame_rate, analysis = _load_samples(path)
+    features = _band_features(analysis)
+    frames_per_sec = ANALYSIS_FRAME_RATE / HOP_SIZE
+    min_match = int(MIN_MATCH_SECS * frames_per_sec)
+    smoothing = max(1, int(MATCH_SMOOTHING_SECS * frames_per_sec))
+
+    similarity = _lag_similarity(features)
+    min_lag = int(min_loop_secs * frames_per_sec)
+    max_lag = len(features) - min_match
+    if max_lag <= min_lag:
+        log.debug(f"{path} is too short to contain a {min_loop_secs}s loop")
+        return None
+
+    candidates = min_lag + np.argsort(similarity[min_lag:max_lag])[::-1]
+    best_lag, best_start, best_length = 0, 0, 0
+    for lag in candidates[:CANDIDATE_LAGS]:
+        lag = int(lag)
+        # the true loop length rarely falls on a whole frame, so compare each frame
+        # against both neighbours of its lagged position
+        frame_similarity = np.maximum(
+            np.einsum("ij,ij->i", features[: -lag - 1], features[lag:-1]),
+            np.einsum("ij,ij->i", features[: -lag - 1], features[lag + 1 :]),
+        )
+        start, length = _longest_match(frame_similarity, smoothing)
+        if length > best_length:
+            best_lag, best_start, best_length = lag, start, length
+
+    if best_length < min_match:
+        log.debug(f"No repeating section found in {path}")
+        return None
+
+    # smoothing smears the start of the match a little early
+    best_start += min(smoothing // 2, best_length // 2)
+    samples_per_frame = frame_rate / frames_per_sec
+    start_sample = int(best_start * samples_per_frame)
+    anchor_sample = int((best_start + best_length // 4) * samples_per_frame)
+    lag_samples = _refine_lag(
+        full,
+        frame_rate,
+        anchor_sample,
+        int(best_lag * samples_per_frame),
+        2 * int(samples_per_frame),
+    )
+    end_sample = start_sample + lag_samples
+    return {
+        "start": f"{start_sample / frame_rate:07.3f}",
+        "end": f"{end_sample / frame_rate:07.3f}",
+        "match_secs": f"{best_length / frames_per_sec:.1f}",
+    }
+
+
+def load_bundled_loop_times() -> dict:
+    """Bundled loop timings, keyed the same way as the detected timings file."""
+    return {
+        "hourly": load_json_resource("hour_loop_times.json"),
+        "kk": load_json_resource("kk_loop_times.json"),
+    }
+
+
+def lookup_loop_timing(
+    loop_times: dict, keys: tuple[str, ...]
+) -> Optional[dict[str, str]]:
+    entry: Any = loop_times
+    for key in keys:
+        entry = entry.get(key)
+        if entry is None:
+            return None
+    return entry
+
+
+def find_loopable_songs() -> list[tuple[tuple[str, ...], Path]]:
+    """
+    Collect loopable files in the music directory along with the keys their timings
+    are stored under.
+    """
+    songs: list[tuple[tuple[str, ...], Path]] = []
+
+    for game in Game:
+        for weather in Weather:
+            song_dir = Path(MUSIC_DIR, game, weather)
+            if not song_dir.is_dir():
+                continue
+            for f in sorted(song_dir.iterdir()):
+                if f.suffix in ALLOWED_SONG_FILETYPES:
+                    songs.append((("hourly", game, weather, f.stem), f))
+
+    for version in LOOPABLE_KK_VERSIONS:
+        song_dir = Path(MUSIC_DIR, "kk", version)
+        if not song_dir.is_dir():
+            continue
+        for f in sorted(song_dir.iterdir()):
+            if f.suffix in ALLOWED_SONG_FILETYPES:
+                songs.append((("kk", f.stem, version), f))
+    return songs
+
+
+def detect_library_loops(
+    include_timed: bool = False,
+    min_loop_secs: float = 20.0,
+    workers: Optional[int] = None,
+) -> tuple[int, int, Path]:
+    """
+    Detect loops for the library in parallel and merge the results into the
+    supplementary timings file. Returns (detected, attempted, output path).
+    """
+    bundled_times = load_bundled_loop_times()
+    songs = [
+        (keys, path)
+        for keys, path in find_loopable_songs()
+        if include_timed or lookup_loop_timing(bundled_times, keys) is None
+    ]
+    output_path = detected_loop_times_path()
+    detected_times = load_detected_loop_times()
+    detected = 0
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {
+            executor.submit(detect_loop, path, min_loop_secs): keys
+            for keys, path in songs
+        }
+        for future in as_completed(futures):
+            keys = futures[future]
+            try:
+                timing = future.result()
+            except Exception as e:
+                log.warning(f"Could not analyze {'/'.join(keys[1:])}: {e}")
+                continue
+            if not timing:
+                log.info(f"No loop found for {'/'.join(keys[1:])}")
+                continue
+
+            entry = detected_times
+            for key in keys[:-1]:
+                entry = entry.setdefault(key, {})
+            entry[keys[-1]] = timing
+            detected += 1
+            log.info(
+                f"Loop found for {'/'.join(keys[1:])}: {timing['start']} to {timing['end']}"
+            )
+
+    with open(output_path, "w") as f:
+        json.dump(detected_times, f, indent=4, sort_keys=True)
+    return detected, len(songs), output_path
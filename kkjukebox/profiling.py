@@ -0,0 +1,151 @@
+import cProfile
+import logging
+import os
+import sys
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from time import perf_counter
+from types import FrameType
+from typing import Iterator, Optional
+
+SAMPLE_INTERVAL_SECS = 0.005
+UNPHASED = "other"
+
+log = logging.getLogger("kkjukebox")
+
+
+class Profiler:
+    """
+    Collects where time goes during a session. Code marks the work it does with
+    `phase()` (decoding, encoding, scanning, ...), which is timed, and a sampler
+    thread records every thread's stack tagged with its current phases so the
+    results can be viewed as flame graphs per phase. The main thread is also run
+    under cProfile.
+
+    Phases nest per context, so concurrent asyncio tasks and worker threads each
+    keep their own. The sampler can only see threads, so it tags each thread with
+    the phases last entered or left on it.
+    """
+
+    enabled: bool
+    output_dir: Optional[Path]
+    _phase_stack: ContextVar[tuple[str, ...]]
+    _phases: dict[int, tuple[str, ...]]
+    _durations: dict[str, list[float]]
+    _samples: Counter[tuple[str, ...]]
+    _cprofile: Optional[cProfile.Profile]
+    _sampler: Optional[threading.Thread]
+    _stop_sampling: threading.Event
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.output_dir = None
+        self._phase_stack = ContextVar("phases", default=())
+        self._phases = {}
+        self._durations = defaultdict(list)
+        self._samples = Counter()
+        self._cprofile = None
+        self._sampler = None
+        self._stop_sampling = threading.Event()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+
+        phases = self._phase_stack.get() + (name,)
+        token = self._phase_stack.set(phases)
+        thread_id = threading.get_ident()
+        self._phases[thread_id] = phases
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            duration = perf_counter() - start
+            self._phase_stack.reset(token)
+            self._phases[thread_id] = self._phase_stack.get()
+            with self._lock:
+                self._durations["/".join(phases)].append(duration)
+
+    def _sample(self) -> None:
+        sampler_id = threading.get_ident()
+        while not self._stop_sampling.wait(SAMPLE_INTERVAL_SECS):
+            for thread_id, thread_frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                frame: Optional[FrameType] = thread_frame
+                stack: list[str] = []
+                while frame:
+                    code = frame.f_code
+                    filename = os.path.basename(code.co_filename)
+                    stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                phases = self._phases.get(thread_id) or (UNPHASED,)
+                with self._lock:
+                    self._samples[phases + tuple(reversed(stack))] += 1
+
+    def start(self, output_dir: str | Path) -> None:
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.enabled = True
+        self._stop_sampling.clear()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+
+    def stop(self) -> str:
+        """Stop collecting, write the results and return the summary table."""
+        if self._cprofile:
+            self._cprofile.disable()
+        self._stop_sampling.set()
+        if self._sampler:
+            self._sampler.join()
+        self.enabled = False
+        return self._write()
+
+    def summary(self) -> str:
+        phase_width = max([len(p) for p in self._durations] + [5])
+        lines = [
+            f"{'phase':<{phase_width}}  {'count':>6}  {'total s':>9}  "
+            f"{'mean s':>9}  {'max s':>9}"
+        ]
+        ranked = sorted(self._durations.items(), key=lambda d: sum(d[1]), reverse=True)
+        for phase_path, durations in ranked:
+            lines.append(
+                f"{phase_path:<{phase_width}}  {len(durations):>6}  "
+                f"{sum(durations):>9.3f}  {sum(durations) / len(durations):>9.3f}  "
+                f"{max(durations):>9.3f}"
+            )
+        return "\n".join(lines)
+
+    def _write(self) -> str:
+        assert self.output_dir
+        if self._cprofile:
+            self._cprofile.dump_stats(self.output_dir / "session.prof")
+
+        # collapsed-stack files, one per top-level phase plus one for everything,
+        # for flamegraph.pl, speedscope, etc.
+        by_phase: dict[str, list[str]] = defaultdict(list)
+        for stack, count in self._samples.most_common():
+            line = f"{';'.join(stack)} {count}"
+            by_phase[stack[0]].append(line)
+            by_phase["all"].append(line)
+        for phase, lines in by_phase.items():
+            with open(self.output_dir / f"{phase}.folded", "w") as f:
+                f.write("\n".join(lines) + "\n")
+
+        summary = self.summary()
+        with open(self.output_dir / "summary.txt", "w") as f:
+            f.write(summary + "\n")
+        log.debug(f"Profile written to {self.output_dir}")
+        return summary
+
+
+profiler = Profiler()
@@ -0,0 +1,143 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from pydub import AudioSegment  # type: ignore
+
+from .loops import (
+    find_loopable_songs,
+    load_bundled_loop_times,
+    load_detected_loop_times,
+    lookup_loop_timing,
+)
+from .song import cut_loop_segments
+
+SEAM_CONTEXT_SAMPLES = 1024
+SPECTRUM_SIZE = 4096
+NUM_BANDS = 32
+SEAM_METRICS = ["discontinuity", "spectral_db", "gain_jump_db"]
+
+log = logging.getLogger("kkjukebox")
+
+
+def _segment_samples(segment: AudioSegment) -> np.ndarray:
+    """Samples as floats shaped (frames, channels)."""
+    scale = float(1 << (8 * segment.sample_width - 1))
+    samples = np.array(segment.get_array_of_samples(), dtype=np.float32) / scale
+    return samples.reshape(-1, segment.channels)
+
+
+def _discontinuity(loop: np.ndarray) -> float:
+    """
+    How far the first sample of the loop lands from where the waveform at the end of
+    the loop was heading, relative to how much the waveform normally bends near the
+    seam. Values around 1 are inaudible; large values are clicks.
+    """
+    head, tail = loop[:SEAM_CONTEXT_SAMPLES], loop[-SEAM_CONTEXT_SAMPLES:]
+    predicted = 2 * tail[-1] - tail[-2]
+    error = np.abs(head[0] - predicted)
+    bends = np.concatenate((np.diff(tail, n=2, axis=0), np.diff(head, n=2, axis=0)))
+    typical = np.sqrt(np.mean(bends**2, axis=0)) + 1e-9
+    return float(np.max(error / typical))
+
+
+def _band_levels_db(samples: np.ndarray) -> np.ndarray:
+    mono = samples.mean(axis=1)
+    spectrum = np.abs(np.fft.rfft(mono * np.hanning(len(mono))))
+    edges = np.unique(np.geomspace(1, len(spectrum), NUM_BANDS + 1).astype(int))
+    bands = np.add.reduceat(spectrum**2, edges[:-1])
+    return 10 * np.log10(bands + 1e-12)
+
+
+def _spectral_mismatch(
+    loop: np.ndarray, original: np.ndarray, start: int, end: int
+) -> float:
+    """
+    RMS difference in band levels (dB) between a window straddling the seam and the
+    same window of the original, where the music carries on naturally past the loop
+    end (or, for files that stop at the loop end, leads into the loop start). The
+    overall level difference from normalizing is removed first.
+    """
+    half = min(SPECTRUM_SIZE, len(loop)) // 2
+    seam = np.concatenate((loop[-half:], loop[:half]))
+    if end + half <= len(original):
+        natural = original[end - half : end + half]
+    else:
+        natural = original[max(start - half, 0) : max(start - half, 0) + 2 * half]
+    difference = _band_levels_db(seam) - _band_levels_db(natural)
+    difference -= difference.mean()
+    return float(np.sqrt(np.mean(difference**2)))
+
+
+def measure_seam(path: str | Path, loop_timing: dict[str, str]) -> dict[str, float]:
+    """
+    Measure the loop seam of a song as it would be cut by `Song._make_loop_files`,
+    without writing the cut files.
+    """
+    original = AudioSegment.from_file(path)
+    _, loop = cut_loop_segments(original, loop_timing)
+    loop_samples = _segment_samples(loop)
+    original_samples = _segment_samples(original)
+    loop_start_ms = float(loop_timing["start"]) * 1000
+    loop_end_ms = float(loop_timing["end"]) * 1000
+    loop_start = int(loop_start_ms * original.frame_rate / 1000)
+    loop_end = int(loop_end_ms * original.frame_rate / 1000)
+
+    # start and loop are normalized separately, so the first pass into the loop
+    # changes volume by however much quieter the loop section peaks
+    gain_jump_db = (
+        original[:loop_end_ms].max_dBFS  # type: ignore
+        - original[loop_start_ms:loop_end_ms].max_dBFS  # type: ignore
+    )
+
+    return {
+        "discontinuity": _discontinuity(loop_samples),
+        "spectral_db": _spectral_mismatch(
+            loop_samples, original_samples, loop_start, loop_end
+        ),
+        "gain_jump_db": float(gain_jump_db),
+    }
+
+
+def scan_library_seams(
+    sort_by: str = "discontinuity", workers: Optional[int] = None
+) -> list[dict]:
+    """
+    Measure the seam of every timed loopable song in parallel, returning report rows
+    ranked worst first by `sort_by`.
+    """
+    bundled_times = load_bundled_loop_times()
+    detected_times = load_detected_loop_times()
+    report: list[dict] = []
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {}
+        for keys, path in find_loopable_songs():
+            timing = lookup_loop_timing(bundled_times, keys) or lookup_loop_timing(
+                detected_times, keys
+            )
+            if timing:
+                futures[executor.submit(measure_seam, path, timing)] = (keys, timing)
+
+        for future in as_completed(futures):
+            keys, timing = futures[future]
+            try:
+                metrics = future.result()
+            except Exception as e:
+                log.warning(f"Could not measure {'/'.join(keys[1:])}: {e}")
+                continue
+            log.debug(f"Measured {'/'.join(keys[1:])}: {metrics}")
+            report.append(
+                {
+                    "song": "/".join(keys[1:]),
+                    "start": timing["start"],
+                    "end": timing["end"],
+                    **metrics,
+                }
+            )
+
+    report.sort(key=lambda r: r[sort_by], reverse=True)
+    return report
@@ -1,14 +1,18 @@
 import datetime
+import json
 import logging
 import os
 import random
 import re
+import threading
 from pathlib import Path
 from typing import Optional
 
 from pydub import AudioSegment, effects  # type: ignore
 
 from .game import Game
+from .library import ALLOWED_SONG_FILETYPES, library
+from .profiling import profiler
 from .utils import load_json_resource
 from .weather import Weather
 
@@ -18,10 +22,55 @@ except KeyError:
     # raise RuntimeError(f"KKJUKEBOX_MUSIC_DIR must be set")
     MUSIC_DIR = ""
 
-ALLOWED_SONG_FILETYPES = [".mp3", ".ogg", ".wav"]
+LOOPABLE_KK_VERSIONS = ["aircheck", "musicbox"]
+DETECTED_LOOP_TIMES_FILENAME = "detected_loop_times.json"
 
 log = logging.getLogger("kkjukebox")
 
+_cut_locks: dict[Path, threading.Lock] = {}
+_cut_locks_guard = threading.Lock()
+
+
+def _cut_lock(path: Path) -> threading.Lock:
+    """
+    Lock for cutting a given song, so background cuts and playback never cut (or read
+    half-written cuts of) the same file at once.
+    """
+    with _cut_locks_guard:
+        return _cut_locks.setdefault(path, threading.Lock())
+
+
+def detected_loop_times_path() -> Path:
+    return Path(MUSIC_DIR, DETECTED_LOOP_TIMES_FILENAME)
+
+
+def load_detected_loop_times() -> dict:
+    """
+    Load the supplementary loop timings written by `kkjukebox detect-loops`, used as a
+    fallback for songs missing from the bundled timing resources.
+    """
+    path = detected_loop_times_path()
+    if not path.is_file():
+        return {"hourly": {}, "kk": {}}
+    with open(path, "rb") as f:
+        return json.load(f)
+
+
+def cut_loop_segments(
+    original: AudioSegment, loop_timing: dict[str, str]
+) -> tuple[AudioSegment, AudioSegment]:
+    """Cut and normalize the start (intro + first loop) and loop segments."""
+    loop_start_ms = float(loop_timing["start"]) * 1000
+    loop_end_ms = float(loop_timing["end"]) * 1000
+
+    log.debug(f"Original track is {len(original)/1000}s")
+    log.debug(f"Cutting loop from {loop_start_ms/1000} to {loop_end_ms/1000}")
+    start = effects.normalize(original[:loop_end_ms])  # type: ignore
+    loop = effects.normalize(original[loop_start_ms:loop_end_ms])  # type: ignore
+    log.debug(f"Start file is {len(start)/1000}s")
+    log.debug(f"Loop file is {len(loop)/1000}s")
+    return start, loop
+
 
 class Song:
 
@@ -56,32 +105,30 @@ class Song:
         start_filepath = f"{loops_dir}/{start_filename}"
         loop_filepath = f"{loops_dir}/{loop_filename}"
 
-        if (
-            not (Path(start_filepath).is_file() and Path(loop_filepath).is_file())
-            or force_cut
-        ):
-            log.debug("Start and/or Loop files not found. Cutting now...")
-
-            loop_start_ms = float(loop_timing["start"]) * 1000
-            loop_end_ms = float(loop_timing["end"]) * 1000
-
-            original = AudioSegment.from_file(path)
-
-            log.debug(f"Making start and loop tracks for {path}")
-            log.debug(f"Original track is {len(original)/1000}s")
-            log.debug(f"Cutting loop from {loop_start_ms/1000} to {loop_end_ms/1000}")
-            start = effects.normalize(original[:loop_end_ms])  # type: ignore
-            loop = effects.normalize(original[loop_start_ms:loop_end_ms])  # type: ignore
-            log.debug(f"Start file is {len(start)/1000}s")
-            log.debug(f"Loop file is {len(loop)/1000}s")
-
-            try:
-                os.mkdir(loops_dir)
-            except FileExistsError:
-                pass
-
-            start.export(start_filepath, format=filetype, parameters=["-aq", "3"])
-            loop.export(loop_filepath, format=filetype, parameters=["-aq", "3"])
+        with _cut_lock(path):
+            if (
+                not (Path(start_filepath).is_file() and Path(loop_filepath).is_file())
+                or force_cut
+            ):
+                log.debug("Start and/or Loop files not found. Cutting now...")
+
+                with profiler.phase("decode"):
+                    original = AudioSegment.from_file(path)
+
+                log.debug(f"Making start and loop tracks for {path}")
+                with profiler.phase("slice"):
+                    start, loop = cut_loop_segments(original, loop_timing)
+
+                try:
+                    os.mkdir(loops_dir)
+                except FileExistsError:
+                    pass
+
+                with profiler.phase("encode"):
+                    start.export(
+                        start_filepath, format=filetype, parameters=["-aq", "3"]
+                    )
+                    loop.export(loop_filepath, format=filetype, parameters=["-aq", "3"])
         return start_filepath, loop_filepath
 
 
@@ -109,7 +156,7 @@ class HourlySong(Song):
             raise OSError(f'Directory "{song_dir}" not found.')
 
         hour_match = str(self.hour).zfill(2)
-        matching_songs = [f for f in song_dir.iterdir() if hour_match == f.stem]
+        matching_songs = library.files(song_dir, hour_match)
         if not matching_songs:
             raise OSError(f'No file found containing "{self.hour}"')
         elif len(matching_songs) > 1:
@@ -128,13 +175,18 @@ class HourlySong(Song):
     def _hour_fill(self) -> str:
         return str(self.hour).zfill(2)
 
-    def make_loop_files(self, force_cut: bool = False) -> tuple[str, str]:
-        hour_path = self.filepath
+    @property
+    def loop_timing(self) -> dict[str, str]:
         hour_str = self._hour_fill
-
         loop_times = load_json_resource("hour_loop_times.json")
-        song_loop_time = loop_times[self.game][self.weather][hour_str]
-        return self._make_loop_files(hour_path, song_loop_time, force_cut)
+        try:
+            return loop_times[self.game][self.weather][hour_str]
+        except KeyError:
+            detected = load_detected_loop_times()["hourly"]
+            return detected[self.game][self.weather][hour_str]
+
+    def make_loop_files(self, force_cut: bool = False) -> tuple[str, str]:
+        return self._make_loop_files(self.filepath, self.loop_timing, force_cut)
 
 
 class KKSong(Song):
@@ -158,9 +210,7 @@ class KKSong(Song):
         all_song_names: list[str] = []
         song_dir = Path(cls.base_music_dir, version)
         if song_dir.is_dir():
-            all_song_names = [
-                f.stem for f in song_dir.iterdir() if f.suffix in ALLOWED_SONG_FILETYPES
-            ]
+            all_song_names = library.song_names(song_dir)
         if shuffle:
             random.shuffle(all_song_names)
         else:
@@ -182,7 +232,7 @@ class KKSong(Song):
         if not song_dir.is_dir():
             raise OSError(f'Directory "{song_dir}" not found.')
 
-        matching_songs = [f for f in song_dir.iterdir() if self.name == f.stem]
+        matching_songs = library.files(song_dir, self.name)
         if not matching_songs:
             raise OSError(f'No file found containing "{self.name}"')
         elif len(matching_songs) > 1:
@@ -195,9 +245,16 @@ class KKSong(Song):
 
     @property
     def is_loopable(self):
-        return self.version in ["aircheck", "musicbox"]
+        return self.version in LOOPABLE_KK_VERSIONS
 
-    def make_loop_files(self, force_cut: bool = False) -> tuple[str, str]:
+    @property
+    def loop_timing(self) -> dict[str, str]:
         loop_times = load_json_resource("kk_loop_times.json")
-        song_loop_time = loop_times[self.name][self.version]
-        return self._make_loop_files(self.filepath, song_loop_time, force_cut)
+        try:
+            return loop_times[self.name][self.version]
+        except KeyError:
+            detected = load_detected_loop_times()["kk"]
+            return detected[self.name][self.version]
+
+    def make_loop_files(self, force_cut: bool = False) -> tuple[str, str]:
+        return self._make_loop_files(self.filepath, self.loop_timing, force_cut)
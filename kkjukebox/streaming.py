@@ -0,0 +1,316 @@
+import os
+
+os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "hide"
+
+import asyncio
+import logging
+import tempfile
+from collections import deque
+from concurrent.futures import Future
+from itertools import islice
+from pathlib import Path
+from typing import Coroutine, Optional
+
+import pygame
+
+STREAM_FORMATS = {
+    "mp3": (["-c:a", "libmp3lame", "-f", "mp3"], "audio/mpeg"),
+    "opus": (["-c:a", "libopus", "-f", "ogg"], "audio/ogg"),
+}
+# pygame.mixer.get_init() sizes to ffmpeg raw sample formats
+PCM_FORMATS = {-8: "s8", 8: "u8", -16: "s16le", 16: "u16le", 32: "f32le"}
+READ_SIZE = 4096
+RING_BUFFER_BYTES = 4 * 1024 * 1024
+BURST_BYTES = 64 * 1024
+LISTENER_TIMEOUT_SECS = 30
+OGG_HEADER_PAGES = 2
+
+log = logging.getLogger("kkjukebox")
+
+
+class StreamBuffer:
+    """
+    Ring buffer of encoded chunks shared by every listener. Chunks are encoded once and
+    handed to each listener as-is; each listener only tracks its own position, and
+    listeners that fall behind the ring skip ahead to the oldest chunk still held.
+    """
+
+    header: bytes
+    closed: bool
+    _chunks: deque[bytes]
+    _first_seq: int
+    _size: int
+    _new_chunk: asyncio.Event
+
+    def __init__(self) -> None:
+        self.header = b""
+        self.closed = False
+        self._chunks = deque()
+        self._first_seq = 0
+        self._size = 0
+        self._new_chunk = asyncio.Event()
+
+    @property
+    def next_seq(self) -> int:
+        return self._first_seq + len(self._chunks)
+
+    def _notify(self) -> None:
+        self._new_chunk.set()
+        self._new_chunk = asyncio.Event()
+
+    def append(self, chunk: bytes) -> None:
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        while self._size > RING_BUFFER_BYTES and len(self._chunks) > 1:
+            self._size -= len(self._chunks.popleft())
+            self._first_seq += 1
+        self._notify()
+
+    def close(self) -> None:
+        self.closed = True
+        self._notify()
+
+    def burst_start(self) -> int:
+        """
+        Where a new listener should start: a little behind live, so their player's
+        buffer fills straight away.
+        """
+        seq, size = self.next_seq, 0
+        for chunk in reversed(self._chunks):
+            if size + len(chunk) > BURST_BYTES:
+                break
+            size += len(chunk)
+            seq -= 1
+        return seq
+
+    async def read(self, seq: int) -> tuple[int, list[bytes]]:
+        """Wait for chunks after `seq`, returning the next position and the chunks."""
+        while seq >= self.next_seq and not self.closed:
+            await self._new_chunk.wait()
+        seq = max(seq, self._first_seq)
+        return self.next_seq, list(islice(self._chunks, seq - self._first_seq, None))
+
+
+def split_ogg_pages(pending: bytearray) -> list[bytes]:
+    """Remove and return every complete Ogg page at the start of `pending`."""
+    pages: list[bytes] = []
+    while len(pending) >= 27:
+        num_segments = pending[26]
+        header_length = 27 + num_segments
+        if len(pending) < header_length:
+            break
+        page_length = header_length + sum(pending[27:header_length])
+        if len(pending) < page_length:
+            break
+        pages.append(bytes(pending[:page_length]))
+        del pending[:page_length]
+    return pages
+
+
+class JukeboxStream:
+    """
+    Serves whatever the jukebox plays as a single HTTP (Icecast-style) audio stream.
+    The pygame mix is captured through SDL's disk audio driver into a FIFO, encoded
+    once by ffmpeg and fanned out to every listener from a shared `StreamBuffer`.
+    """
+
+    host: str
+    port: int
+    stream_format: str
+    bitrate: int
+    buffer: StreamBuffer
+    listeners: int
+    _fifo_dir: Optional[str]
+    _fifo_fd: Optional[int]
+
+    def __init__(
+        self,
+        host: str = "0.0.0.0",
+        port: int = 8000,
+        stream_format: str = "mp3",
+        bitrate: int = 128,
+    ) -> None:
+        if stream_format not in STREAM_FORMATS:
+            raise ValueError(f'"{stream_format}" is not a supported stream format')
+        self.host = host
+        self.port = port
+        self.stream_format = stream_format
+        self.bitrate = bitrate
+        self.buffer = StreamBuffer()
+        self.listeners = 0
+        self._fifo_dir = None
+        self._fifo_fd = None
+
+    def open_output(self) -> None:
+        """
+        Point pygame's audio output at a FIFO. Must be called before the mixer is
+        initialized, i.e. before creating the `Jukebox`.
+        """
+        self._fifo_dir = tempfile.mkdtemp(prefix="kkjukebox-")
+        fifo_path = os.path.join(self._fifo_dir, "mix.pcm")
+        os.mkfifo(fifo_path)
+        # hold the read end open so SDL can open the write end without blocking
+        self._fifo_fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        os.set_blocking(self._fifo_fd, True)
+        os.environ["SDL_AUDIODRIVER"] = "disk"
+        os.environ["SDL_DISKAUDIOFILE"] = fifo_path
+        # SDL's own pacing sleeps a whole number of milliseconds per buffer, which
+        # drifts from real time; leave the pacing to the encoder reading the FIFO
+        os.environ["SDL_DISKAUDIODELAY"] = "0"
+
+    def _close_output(self) -> None:
+        if self._fifo_fd is not None:
+            os.close(self._fifo_fd)
+            self._fifo_fd = None
+        if self._fifo_dir:
+            for f in Path(self._fifo_dir).iterdir():
+                f.unlink()
+            os.rmdir(self._fifo_dir)
+            self._fifo_dir = None
+
+    async def _start_encoder(self) -> asyncio.subprocess.Process:
+        mixer_init = pygame.mixer.get_init()
+        if not mixer_init or self._fifo_fd is None:
+            raise RuntimeError("Stream output must be opened before the jukebox")
+        frequency, size, channels = mixer_init
+        codec_args, _ = STREAM_FORMATS[self.stream_format]
+        encoder = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            # read at the native rate; SDL blocks on the full FIFO, keeping the mix live
+            "-re",
+            "-f",
+            PCM_FORMATS[size],
+            "-ar",
+            str(frequency),
+            "-ac",
+            str(channels),
+            "-i",
+            "pipe:0",
+            *codec_args,
+            "-b:a",
+            f"{self.bitrate}k",
+            "pipe:1",
+            stdin=self._fifo_fd,
+            stdout=asyncio.subprocess.PIPE,
+            # keep Ctrl-C from reaching the encoder; it's stopped once playing ends
+            start_new_session=True,
+        )
+        # ffmpeg has its own copy of the read end now
+        self._close_output()
+        return encoder
+
+    async def _pump_encoder(self, encoder: asyncio.subprocess.Process) -> None:
+        assert encoder.stdout
+        pending = bytearray()
+        header_pages = OGG_HEADER_PAGES if self.stream_format == "opus" else 0
+        while chunk := await encoder.stdout.read(READ_SIZE):
+            if self.stream_format != "opus":
+                self.buffer.append(chunk)
+                continue
+            # ogg listeners have to start on a page boundary after the header pages
+            pending += chunk
+            for page in split_ogg_pages(pending):
+                if header_pages:
+                    self.buffer.header += page
+                    header_pages -= 1
+                else:
+                    self.buffer.append(page)
+        self.buffer.close()
+        raise RuntimeError(f"Stream encoder exited ({await encoder.wait()})")
+
+    async def _handle_listener(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        peer = writer.get_extra_info("peername")
+        listening = False
+        try:
+            request = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), LISTENER_TIMEOUT_SECS
+            )
+            method = request.split(b" ", 1)[0]
+            if method not in (b"GET", b"HEAD"):
+                writer.write(b"HTTP/1.0 405 Method Not Allowed\r\n\r\n")
+                return
+
+            _, content_type = STREAM_FORMATS[self.stream_format]
+            writer.write(
+                (
+                    "HTTP/1.0 200 OK\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    "Cache-Control: no-cache, no-store\r\n"
+                    "Connection: close\r\n"
+                    "icy-name: kkjukebox\r\n"
+                    f"icy-br: {self.bitrate}\r\n"
+                    "\r\n"
+                ).encode()
+            )
+            if method == b"HEAD":
+                return
+
+            listening = True
+            self.listeners += 1
+            log.info(f"Listener connected from {peer} ({self.listeners} listening)")
+            writer.write(self.buffer.header)
+            seq = self.buffer.burst_start()
+            while True:
+                seq, chunks = await self.buffer.read(seq)
+                if not chunks:
+                    break
+                writer.writelines(chunks)
+                await asyncio.wait_for(writer.drain(), LISTENER_TIMEOUT_SECS)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            if listening:
+                self.listeners -= 1
+                log.info(f"Listener {peer} disconnected ({self.listeners} listening)")
+            writer.close()
+
+    async def _stream(self, stop: Future) -> None:
+        """Encode the mix and serve it to listeners until `stop` is set."""
+        encoder = await self._start_encoder()
+        server = await asyncio.start_server(self._handle_listener, self.host, self.port)
+        log.info(f"Streaming {self.stream_format} on http://{self.host}:{self.port}/")
+        pump = asyncio.create_task(self._pump_encoder(encoder))
+        try:
+            async with server:
+                await asyncio.wait(
+                    {pump, asyncio.wrap_future(stop)},
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if pump.done():
+                    pump.result()
+        finally:
+            pump.cancel()
+            # lets listeners finish up rather than being cancelled mid-write
+            self.buffer.close()
+            if encoder.returncode is None:
+                # nothing reads its output any more, so it can't flush and exit cleanly
+                encoder.kill()
+                await encoder.wait()
+            self._close_output()
+
+    async def serve(self, play: Coroutine) -> None:
+        """
+        Run the jukebox coroutine `play` while serving its output to listeners. The
+        stream runs on its own thread and event loop, so the jukebox's blocking work
+        (cutting, decoding, lookups) can't hold up listeners.
+        """
+        stop: Future = Future()
+        streaming = asyncio.get_running_loop().run_in_executor(
+            None, asyncio.run, self._stream(stop)
+        )
+        player = asyncio.ensure_future(play)
+        try:
+            done, _ = await asyncio.wait(
+                {streaming, player}, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                task.result()
+        finally:
+            player.cancel()
+            stop.set_result(None)
+            await asyncio.wait({streaming})